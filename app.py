@@ -1,172 +1,305 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
 from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, FileResponse
-from fastapi.encoders import jsonable_encoder
 from fastapi.responses import ORJSONResponse
-from typing import List, Dict
-import io, time, os, threading, zipfile, json, uuid, csv, tempfile
+from typing import BinaryIO, Dict, List, Set, Tuple
+from dataclasses import dataclass, field
+import asyncio, gzip, hashlib, heapq, time, os, shutil, threading, zipfile, uuid, tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
+import orjson
 
-from core import xml_rows_to_dataframe, iter_xml_rows  # parsing utils live in core.py
-import pyarrow as pa
-import pyarrow.parquet as pq
-from openpyxl import Workbook
+from writers import convert_one, gzip_sibling, preview_one, row_tag_path, worker_init
 
 app = FastAPI(title="Simple XML to Excel Converter (Web)", default_response_class=ORJSONResponse)
 
+@dataclass(slots=True)
+class Job:
+    status: str = "QUEUED"
+    progress: int = 0
+    current: int = 0
+    total: int = 0
+    file: str = ""
+    error: str = ""
+    result_path: str = ""  # set when the output is created; only served after SUCCESS
+    result_filename: str = ""
+    seq: int = 0  # bumped on every update; lets /progress and /status spot changes
+    finished: float | None = None
+    uploads: tuple = ()  # upload ids this job reads; kept out of the temp_uploads sweep
+    staging: List[str] = field(default_factory=list)  # per-file temp outputs of a multi-file job
+
 # In-memory job registry for background threads
-jobs = {}
+jobs: Dict[str, Job] = {}
 jobs_lock = threading.Lock()
+# job_id -> {(event loop, asyncio.Event)} for open /progress streams
+job_waiters: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+# Finished jobs (and their artifacts on disk) are dropped after this many seconds
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+
+# e.g. "/_protected/": /download answers with an X-Accel-Redirect header instead of the file
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "")
+
+class ChunkedFileResponse(FileResponse):
+    chunk_size = 256 * 1024  # fewer send() calls than Starlette's 64 KiB default
 
 def _update_job(job_id: str, **kwargs):
+    job = jobs.get(job_id)
+    if job is None:
+        with jobs_lock:
+            job = jobs.setdefault(job_id, Job())
+    # After creation a job is only written by its own coordinator thread, so fields
+    # are set in place without the lock; seq moves last so readers never see it early
+    for k, v in kwargs.items():
+        setattr(job, k, v)
+    if kwargs.get("status") in ("SUCCESS", "FAILURE"):
+        job.finished = time.time()
+    job.seq += 1
+    if job_id not in job_waiters:
+        return
     with jobs_lock:
-        job = jobs.get(job_id, {})
-        job.update(kwargs)
-        jobs[job_id] = job
+        waiters = list(job_waiters.get(job_id, ()))
+    # Wake SSE streams from whichever thread is reporting progress
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:  # loop already closed
+            pass
+
+def _remove_job_files(job: Job):
+    """Delete a job's output, its .gz sibling (precompressed CSV) and any staging files."""
+    paths = [job.result_path, job.result_path + ".gz"] if job.result_path else []
+    for p in paths + job.staging:
+        if os.path.exists(p):
+            try:
+                os.remove(p)
+            except Exception:
+                pass
+
+def _purge_expired_jobs():
+    """Forget finished jobs past JOB_TTL_SECONDS and delete stale results/uploads.
+
+    Uploads still referenced by a registered job are kept whatever their age, so
+    a job never loses its input (or its .rowtag) to the sweep. Does blocking file
+    I/O: call it off the event loop.
+    """
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with jobs_lock:
+        expired = [jid for jid, job in jobs.items() if job.finished is not None and job.finished < cutoff]
+        gone = [jobs.pop(jid) for jid in expired]
+        in_use = {fid for job in jobs.values() for fid in job.uploads}
+    for job in gone:
+        _remove_job_files(job)
+    if os.path.isdir("temp_uploads"):
+        for entry in os.scandir("temp_uploads"):
+            # <id>.xml and its <id>.rowtag sidecar share the upload id
+            if os.path.splitext(entry.name)[0] in in_use:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except Exception:
+                pass
+
+# ----------- Shared worker pool (started once, reused by every job) -----------
+
+pool_executor: ProcessPoolExecutor | None = None
+# Jobs are coordinated on a bounded thread pool (they mostly wait on pool_executor),
+# so a burst of /convert calls queues up instead of spawning a thread each
+job_executor: ThreadPoolExecutor | None = None
+pool_lock = threading.Lock()
+
+def _ncpu() -> int:
+    # cpu_count() reports the host's CPUs; affinity reflects what this container may use
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+# Files one multi-file job may have in the pool at once. The pool runs tasks in
+# FIFO order, so a big batch submitted whole would queue every other user's
+# preview and job behind it
+JOB_MAX_IN_FLIGHT = max(1, _ncpu() // 2)
+
+def _pool_context() -> multiprocessing.context.BaseContext:
+    # Forking this multithreaded server can copy held locks into the child; start
+    # workers from a clean forkserver (spawn where that's unavailable) instead
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def _get_pool() -> ProcessPoolExecutor:
+    global pool_executor
+    with pool_lock:
+        if pool_executor is None:
+            pool_executor = ProcessPoolExecutor(max_workers=_ncpu(), mp_context=_pool_context(),
+                                                initializer=worker_init)
+        return pool_executor
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    """Drop a pool that lost a worker (BrokenProcessPool); _get_pool builds a fresh one."""
+    global pool_executor
+    with pool_lock:
+        if pool_executor is broken:  # another caller may have replaced it already
+            pool_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _pool_submit(fn, *args) -> Tuple[Future, ProcessPoolExecutor]:
+    """Submit to the shared pool, rebuilding it once if it is already broken."""
+    pool = _get_pool()
+    try:
+        return pool.submit(fn, *args), pool
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        pool = _get_pool()
+        return pool.submit(fn, *args), pool
+
+def _run_in_pool(fn, *args):
+    """fn(*args) in the shared pool. If a worker dies meanwhile (OOM-kill, crash),
+    the pool is rebuilt and the call retried once."""
+    fut, pool = _pool_submit(fn, *args)
+    try:
+        return fut.result()
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        return _pool_submit(fn, *args)[0].result()
+
+async def _run_in_pool_async(fn, *args):
+    """_run_in_pool for the event loop."""
+    loop = asyncio.get_running_loop()
+    fut, pool = _pool_submit(fn, *args)
+    try:
+        return await asyncio.wrap_future(fut, loop=loop)
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        return await asyncio.wrap_future(_pool_submit(fn, *args)[0], loop=loop)
+
+def _get_job_executor() -> ThreadPoolExecutor:
+    global job_executor
+    with pool_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=_ncpu(), thread_name_prefix="job")
+        return job_executor
+
+@app.on_event("startup")
+def _start_pool():
+    _get_pool()
+    _get_job_executor()
+
+@app.on_event("shutdown")
+def _stop_pool():
+    global pool_executor, job_executor
+    with pool_lock:
+        if job_executor is not None:
+            job_executor.shutdown(wait=False, cancel_futures=True)
+            job_executor = None
+        if pool_executor is not None:
+            pool_executor.shutdown(wait=False, cancel_futures=True)
+            pool_executor = None
 
 def _run_conversion(job_id: str, file_ids: List[str], file_names: List[str], columns: List[str], output_format: str):
     try:
         os.makedirs("outputs", exist_ok=True)
         total = len(file_ids)
-        _update_job(job_id, status="PROGRESS", progress=0, current=0, total=total, file="")
-
-        def stream_csv_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
-            with open(out_path, "w", newline="", encoding="utf-8") as f:
-                writer = None
-                if header_cols is not None:
-                    header = list(header_cols)
-                    if not header:
-                        return
-                    writer = csv.DictWriter(f, fieldnames=header, extrasaction='ignore')
-                    writer.writeheader()
-                    for r in iter_xml_rows(xml_path):
-                        if any((r.get(k) is not None and r.get(k) != "") for k in header):
-                            writer.writerow({k: r.get(k) for k in header})
-                else:
-                    first_row = None
-                    for r in iter_xml_rows(xml_path):
-                        first_row = r
-                        break
-                    if first_row is None or not first_row:
-                        return
-                    header = list(first_row.keys())
-                    writer = csv.DictWriter(f, fieldnames=header, extrasaction='ignore')
-                    writer.writeheader()
-                    if any((first_row.get(k) is not None and first_row.get(k) != "") for k in header):
-                        writer.writerow({k: first_row.get(k) for k in header})
-                    for r in iter_xml_rows(xml_path):
-                        if any((r.get(k) is not None and r.get(k) != "") for k in header):
-                            writer.writerow({k: r.get(k) for k in header})
-
-        def stream_parquet_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
-            header = header_cols if header_cols else None
-            writer = None
-            batch_size = 20000
-            rows_buffer = []
-            for r in iter_xml_rows(xml_path):
-                if header is None:
-                    header = list(r.keys())
-                rows_buffer.append({k: r.get(k) for k in header})
-                if len(rows_buffer) >= batch_size:
-                    table = pa.Table.from_pylist(rows_buffer)
-                    if writer is None:
-                        writer = pq.ParquetWriter(out_path, table.schema)
-                    writer.write_table(table)
-                    rows_buffer.clear()
-            if rows_buffer:
-                table = pa.Table.from_pylist(rows_buffer)
-                if writer is None:
-                    writer = pq.ParquetWriter(out_path, table.schema)
-                writer.write_table(table)
-                rows_buffer.clear()
-            if writer is not None:
-                writer.close()
-
-        def stream_xlsx_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
-            wb = Workbook(write_only=True)
-            ws = wb.create_sheet("Rows")
-            header = header_cols if header_cols else None
-            first_row = None
-            it = iter_xml_rows(xml_path)
-            for r in it:
-                first_row = r
-                break
-            if header is None:
-                header = list(first_row.keys()) if first_row else []
-            if not header:
-                wb.save(out_path)
-                wb.close()
-                return
-            ws.append(header)
-            if first_row is not None:
-                row_vals = [first_row.get(k) for k in header]
-                if any((v is not None and v != "") for v in row_vals):
-                    ws.append(row_vals)
-            for r in iter_xml_rows(xml_path):
-                row_vals = [r.get(k) for k in header]
-                if any((v is not None and v != "") for v in row_vals):
-                    ws.append(row_vals)
-            wb.save(out_path)
-            wb.close()
 
         if total > 1:
+            # Output and staging paths go on the job as soon as they exist, so a
+            # failure here or the TTL purge can always find and delete them
             zip_path = f"outputs/{job_id}.zip"
-            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-                for idx, (fid, fname) in enumerate(zip(file_ids, file_names), start=1):
-                    xml_path = f"temp_uploads/{fid}.xml"
-                    if not os.path.exists(xml_path):
-                        raise FileNotFoundError(f"Missing uploaded file: {xml_path}")
-                    base = os.path.splitext(os.path.basename(fname))[0]
-                    _update_job(job_id, current=idx, file=fname, progress=int((idx - 1) / total * 100))
-                    tmp = None
-                    if output_format == "csv":
-                        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".csv"); tmp.close()
-                        stream_csv_to_path(xml_path, tmp.name, columns if columns else None)
-                        zf.write(tmp.name, arcname=f"{base}.csv")
-                    elif output_format == "parquet":
-                        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".parquet"); tmp.close()
-                        stream_parquet_to_path(xml_path, tmp.name, columns if columns else None)
-                        zf.write(tmp.name, arcname=f"{base}.parquet")
-                    else:
-                        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx"); tmp.close()
-                        stream_xlsx_to_path(xml_path, tmp.name, columns if columns else None)
-                        zf.write(tmp.name, arcname=f"{base}.xlsx")
-                    try:
-                        os.remove(tmp.name)
-                    except Exception:
-                        pass
-                    _update_job(job_id, current=idx, file=fname, progress=int((idx) / total * 100))
-            _update_job(job_id, status="SUCCESS", result_path=zip_path, result_filename="converted_files.zip")
+            tmp_paths: List[str] = []
+            _update_job(job_id, status="PROGRESS", progress=0, current=0, total=total, file="",
+                        result_path=zip_path, staging=tmp_paths)
+            # Files are independent and parsing is CPU-bound Python, so convert them
+            # in worker processes; only the zip is assembled on this thread.
+            header_cols = columns if columns else None
+            tasks = []
+            for fid, fname in zip(file_ids, file_names):
+                xml_path = f"temp_uploads/{fid}.xml"
+                if not os.path.exists(xml_path):
+                    raise FileNotFoundError(f"Missing uploaded file: {xml_path}")
+                base = os.path.splitext(os.path.basename(fname))[0]
+                tasks.append((xml_path, fname, f"{base}.{output_format}"))
+            # Deflate every member at level 1. .xlsx and .parquet are compressed already,
+            # but rows repeat beyond their compressors' windows, so storing them bloats
+            # the zip several-fold; level 1 keeps most of the gain for a fraction of
+            # the CPU that the default level 6 costs (CSV included).
+            futures: Dict[Future, Tuple[tuple, str, ProcessPoolExecutor, bool]] = {}
+            pending = deque(tasks)
+
+            def submit(task, tmp_path, retried=False):
+                xml_path = task[0]
+                fut, pool = _pool_submit(convert_one, xml_path, tmp_path, output_format, header_cols)
+                futures[fut] = (task, tmp_path, pool, retried)
+
+            try:
+                with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+                    idx = 0
+                    while pending or futures:
+                        while pending and len(futures) < JOB_MAX_IN_FLIGHT:
+                            # Stage next to the zip: /tmp is often tmpfs or another filesystem
+                            tmp = tempfile.NamedTemporaryFile(delete=False, dir="outputs", suffix=f".{output_format}"); tmp.close()
+                            tmp_paths.append(tmp.name)
+                            submit(pending.popleft(), tmp.name)
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            task, tmp_path, pool, retried = futures.pop(fut)
+                            try:
+                                fut.result()
+                            except BrokenProcessPool:
+                                # A worker died (maybe running someone else's file): rebuild, retry once
+                                if retried:
+                                    raise
+                                _reset_pool(pool)
+                                submit(task, tmp_path, retried=True)
+                                continue
+                            _, fname, arcname = task
+                            zf.write(tmp_path, arcname=arcname)
+                            try:
+                                os.remove(tmp_path)
+                            except Exception:
+                                pass
+                            idx += 1
+                            _update_job(job_id, current=idx, file=fname, progress=int(idx / total * 100))
+            finally:
+                # On failure, don't leave this job's remaining files running in the shared pool
+                for fut in futures:
+                    fut.cancel()
+                wait(futures)
+                for tmp_path in tmp_paths:
+                    if os.path.exists(tmp_path):
+                        try:
+                            os.remove(tmp_path)
+                        except Exception:
+                            pass
+            _update_job(job_id, status="SUCCESS", result_filename="converted_files.zip")
         else:
             fid, fname = file_ids[0], file_names[0]
+            out_path = f"outputs/{job_id}.{output_format}"
+            _update_job(job_id, status="PROGRESS", progress=0, current=1, total=1, file=fname, result_path=out_path)
             xml_path = f"temp_uploads/{fid}.xml"
             if not os.path.exists(xml_path):
                 raise FileNotFoundError(f"Missing uploaded file: {xml_path}")
             base = os.path.splitext(os.path.basename(fname))[0]
-            _update_job(job_id, current=1, total=1, file=fname, progress=0)
+            result_name = f"{base}.{output_format}"
+            # Parse in a worker process too, keeping this process's GIL free for requests
+            _run_in_pool(convert_one, xml_path, out_path, output_format, columns if columns else None)
             if output_format == "csv":
-                out_path = f"outputs/{job_id}.csv"
-                stream_csv_to_path(xml_path, out_path, columns if columns else None)
-                result_name = f"{base}.csv"
-            elif output_format == "parquet":
-                out_path = f"outputs/{job_id}.parquet"
-                stream_parquet_to_path(xml_path, out_path, columns if columns else None)
-                result_name = f"{base}.parquet"
-            else:
-                out_path = f"outputs/{job_id}.xlsx"
-                stream_xlsx_to_path(xml_path, out_path, columns if columns else None)
-                result_name = f"{base}.xlsx"
-            _update_job(job_id, status="SUCCESS", result_path=out_path, result_filename=result_name, progress=100)
+                _run_in_pool(gzip_sibling, out_path)
+            _update_job(job_id, status="SUCCESS", result_filename=result_name, progress=100)
     except Exception as e:
+        # Nothing of a failed job can be downloaded: drop its partial output now
+        job = jobs.get(job_id)
+        if job is not None:
+            _remove_job_files(job)
         _update_job(job_id, status="FAILURE", error=str(e))
 
-# ----------- In-memory helper for SSE formatting (kept for symmetry) -----------
-def sse(event: str, data: dict) -> str:
-    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+# ----------- SSE formatting for /progress -----------
+def sse(event: str, data: dict, _d=orjson.dumps) -> str:
+    return f"event: {event}\ndata: {_d(data).decode()}\n\n"
 
 # ----------- UI (kept same style, plus Preview/Column picker/Format) -----------
 
-@app.get("/", response_class=HTMLResponse)
-async def index():
-    return """
+INDEX_HTML = """
     <!doctype html>
     <html>
       <head>
@@ -278,19 +411,19 @@ async def index():
             previewTables.innerHTML = '';
             lastPreviewData.files.forEach(file => {
               const cols = file.columns;
-              const rows = file.rows;
+              const data = file.data;
               let tableHTML = '<h4>' + file.name + '</h4>';
               tableHTML += '<div style="overflow:auto; max-height:50vh;"><table><thead><tr>';
               cols.forEach(col => { tableHTML += `<th>${col}</th>`; });
               tableHTML += '</tr></thead><tbody>';
-              rows.forEach(row => {
+              for (let i = 0; i < file.num_rows; i++) {
                 tableHTML += '<tr>';
-                cols.forEach((col, j) => {
-                  let cell = row[j]; if (cell === null) cell = '';
+                cols.forEach(col => {
+                  let cell = data[col][i]; if (cell === null) cell = '';
                   tableHTML += `<td>${cell}</td>`;
                 });
                 tableHTML += '</tr>';
-              });
+              }
               tableHTML += '</tbody></table></div>';
               previewTables.innerHTML += tableHTML;
             });
@@ -361,15 +494,11 @@ async def index():
               convertBtn.disabled = false; previewBtn.disabled = false; return;
             }
             statusEl.textContent = 'Processing...';
-            // poll status
-            const timer = setInterval(async () => {
-              const r = await fetch(`/status/${jobId}`);
-              if (!r.ok) {
-                try { const t = await r.text(); statusEl.textContent = `Status error: ${t}`; } catch(_) {}
-                return;
-              }
+            // progress is pushed by the server as it changes
+            const es = new EventSource(`/progress/${jobId}`);
+            es.addEventListener('progress', (e) => {
               let s;
-              try { s = await r.json(); }
+              try { s = JSON.parse(e.data); }
               catch(_) { statusEl.textContent = 'Status parse error'; return; }
               if (s.status === 'PROGRESS') {
                 const pct = s.progress || 0; bar.style.width = pct + '%';
@@ -377,62 +506,151 @@ async def index():
                 else statusEl.textContent = `Processing... ${pct}%`;
               }
               if (s.status === 'SUCCESS') {
-                clearInterval(timer);
+                es.close();
                 bar.style.width = '100%'; statusEl.textContent = 'Done!';
                 downloadLink.href = `/download/${jobId}`; downloadLink.style.display = 'inline';
                 convertBtn.disabled = false; previewBtn.disabled = false;
               }
               if (s.status === 'FAILURE') {
-                clearInterval(timer);
+                es.close();
                 statusEl.textContent = 'Error during conversion';
                 alert('Conversion failed: ' + (s.error || 'Unknown error'));
                 convertBtn.disabled = false; previewBtn.disabled = false;
               }
-            }, 1000);
+            });
+            es.onerror = () => {
+              if (es.readyState === EventSource.CLOSED) {
+                statusEl.textContent = 'Lost connection to progress stream';
+                convertBtn.disabled = false; previewBtn.disabled = false;
+              }
+            };
           });
         </script>
       </body>
     </html>
     """
 
+def _accepts_gzip(request: Request) -> bool:
+    """Whether Accept-Encoding allows gzip: an explicit gzip entry decides, else
+    a * entry does; a q-value of 0 (e.g. "gzip;q=0") means not acceptable."""
+    star = False
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding == "*":
+            star = q > 0
+        else:
+            return q > 0
+    return star
+
+# The page never changes: encode it, and gzip it once at import, not per request
+_INDEX = INDEX_HTML.encode()
+_INDEX_GZ = gzip.compress(_INDEX, compresslevel=9)
+# Revalidated on every load (no-cache) against an ETag from the gzipped bytes, so
+# a redeploy shows up at once while unchanged pages cost a bodiless 304
+_INDEX_TAG = hashlib.sha1(_INDEX_GZ).hexdigest()[:16]
+_INDEX_ETAGS = {True: f'"{_INDEX_TAG}-gz"', False: f'"{_INDEX_TAG}"'}
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    gz = _accepts_gzip(request)
+    headers = {"ETag": _INDEX_ETAGS[gz], "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    if gz:
+        return HTMLResponse(_INDEX_GZ, headers={**headers, "Content-Encoding": "gzip"})
+    return HTMLResponse(_INDEX, headers=headers)
+
 @app.head("/")
 async def index_head():
     return PlainTextResponse("", status_code=200)
 
 # ----------- Preview endpoint (returns 10 rows + union of columns) -----------
 
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MAX_PREVIEW_COLUMNS = int(os.getenv("MAX_PREVIEW_COLUMNS", "100"))
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+def _copy_upload(src: BinaryIO, path: str) -> None:
+    src.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(src, f, UPLOAD_CHUNK_BYTES)
+
+async def _save_upload(upload: UploadFile, path: str):
+    """Copy an upload's spooled file to path in one worker-thread call.
+
+    The size is known once the form is parsed, so too-large uploads are
+    rejected before anything is copied.
+    """
+    size = upload.size
+    if size is None:
+        size = upload.file.seek(0, os.SEEK_END)
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large: {upload.filename}")
+    await asyncio.to_thread(_copy_upload, upload.file, path)
+
+def _remove_uploads(file_ids: List[str]):
+    """Delete uploads (and their .rowtag sidecars) that no job will ever reference."""
+    for fid in file_ids:
+        xml_path = f"temp_uploads/{fid}.xml"
+        for p in (xml_path, row_tag_path(xml_path)):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
 @app.post("/preview")
 async def preview_files(files: List[UploadFile] = File(...)):
     if not files:
         raise HTTPException(status_code=400, detail="No files uploaded")
     os.makedirs("temp_uploads", exist_ok=True)
-    previews = []
-    all_columns = set()
     for upload in files:
-        if not upload.filename.lower().endswith(".xml"):
+        if not (upload.filename or "").lower().endswith(".xml"):
             raise HTTPException(status_code=400, detail=f"Only .xml files allowed: {upload.filename}")
-        data = await upload.read()
-        if len(data) > 50 * 1024 * 1024:
-            raise HTTPException(status_code=413, detail=f"File too large: {upload.filename}")
-        try:
-            df = xml_rows_to_dataframe(data)
-        except Exception as e:
-            raise HTTPException(status_code=422, detail=f"Failed to parse {upload.filename}: {e}")
-        preview_df = df.head(10) if not df.empty else df
-        preview_df = preview_df.fillna("")
-        columns = list(preview_df.columns)
-        rows = preview_df.values.tolist()
-        file_id = str(uuid.uuid4())
-        with open(f"temp_uploads/{file_id}.xml", "wb") as f:
-            f.write(data)
-        previews.append({"id": file_id, "name": upload.filename, "columns": columns, "rows": rows})
-        all_columns.update(columns)
-    # Limit number of columns returned to frontend for performance
-    MAX_PREVIEW_COLUMNS = int(os.getenv("MAX_PREVIEW_COLUMNS", "100"))
-    all_columns_list = list(all_columns)
-    all_columns_list.sort()
-    limited_columns = all_columns_list[:MAX_PREVIEW_COLUMNS]
-    hidden_count = max(0, len(all_columns_list) - len(limited_columns))
+    file_ids = [str(uuid.uuid4()) for _ in files]
+    # Copy all uploads to disk concurrently; let every copy settle before reacting
+    # to a failure so none is left writing a file after the error is returned
+    saved = await asyncio.gather(
+        *(_save_upload(upload, f"temp_uploads/{fid}.xml") for upload, fid in zip(files, file_ids)),
+        return_exceptions=True)
+    for result in saved:
+        if isinstance(result, BaseException):
+            _remove_uploads(file_ids)
+            raise result
+    # Parse every file in the worker pool at once, keeping the event loop free.
+    # Submitting, awaiting and checking all sit in one cleanup block: whatever
+    # fails (a parse error, a broken pool, a cancelled request) removes the uploads
+    previews = []
+    all_columns = set()
+    try:
+        results = await asyncio.gather(
+            *(_run_in_pool_async(preview_one, f"temp_uploads/{fid}.xml") for fid in file_ids),
+            return_exceptions=True)
+        for upload, file_id, result in zip(files, file_ids, results):
+            if isinstance(result, BaseException):
+                raise HTTPException(status_code=422, detail=f"Failed to parse {upload.filename}: {result}")
+            columns, data, num_rows = result
+            # Column-major with nulls left as-is: one list per column, no per-row arrays
+            previews.append({"id": file_id, "name": upload.filename, "columns": columns, "data": data, "num_rows": num_rows})
+            all_columns.update(columns)
+    except BaseException:
+        # The whole request fails, so none of its uploads can be converted
+        _remove_uploads(file_ids)
+        raise
+    # Limit number of columns returned to frontend for performance; nsmallest keeps
+    # only the first MAX_PREVIEW_COLUMNS in sorted order instead of sorting them all
+    limited_columns = heapq.nsmallest(MAX_PREVIEW_COLUMNS, all_columns)
+    hidden_count = max(0, len(all_columns) - len(limited_columns))
     return {"files": previews, "columns": limited_columns, "hidden_columns_count": hidden_count}
 
 # ----------- Background conversion via Celery -----------
@@ -452,40 +670,92 @@ async def start_conversion(payload: Dict):
         raise HTTPException(status_code=400, detail="format must be xlsx, csv, or parquet")
 
     job_id = str(uuid.uuid4())
-    _update_job(job_id, status="QUEUED", progress=0)
-    t = threading.Thread(target=_run_conversion, args=(job_id, file_ids, file_names, columns, fmt), daemon=True)
-    t.start()
+    # Register the job (and the uploads it needs) before sweeping, so the sweep
+    # can't delete this request's own inputs
+    _update_job(job_id, status="QUEUED", progress=0, uploads=tuple(file_ids))
+    await asyncio.to_thread(_purge_expired_jobs)
+    _get_job_executor().submit(_run_conversion, job_id, file_ids, file_names, columns, fmt)
     return {"job_id": job_id}
 
-@app.get("/status/{job_id}")
-def get_status(job_id: str):
-    job = jobs.get(job_id)
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found")
-    status = job.get("status", "PROGRESS")
+def _job_state(job: Job) -> Dict:
+    status = job.status
     if status == "SUCCESS":
         return {"status": "SUCCESS"}
     if status == "FAILURE":
-        return {"status": "FAILURE", "error": job.get("error", "Unknown error")}
+        return {"status": "FAILURE", "error": job.error or "Unknown error"}
     return {
         "status": "PROGRESS",
-        "progress": job.get("progress", 0),
-        "current": job.get("current", 0),
-        "total": job.get("total", 0),
-        "file": job.get("file", "")
+        "progress": job.progress,
+        "current": job.current,
+        "total": job.total,
+        "file": job.file
     }
 
+@app.get("/status/{job_id}")
+def get_status(job_id: str, request: Request, response: Response):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # seq moves on every update, so pollers revalidating an unchanged job get a bodiless 304
+    etag = f'"{job.seq}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return _job_state(job)
+
+@app.get("/progress/{job_id}")
+async def progress_stream(job_id: str):
+    """SSE stream of job state; a frame is sent only when the job's seq has moved."""
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with jobs_lock:
+        job_waiters.setdefault(job_id, set()).add(waiter)
+
+    async def gen():
+        event = waiter[1]
+        last_seq = None
+        try:
+            while True:
+                event.clear()
+                job = jobs.get(job_id)
+                seq = job.seq if job else -1
+                if seq != last_seq:
+                    last_seq = seq
+                    state = _job_state(job) if job else {"status": "FAILURE", "error": "Job not found"}
+                    yield sse("progress", state)
+                    if state["status"] in ("SUCCESS", "FAILURE"):
+                        return
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            with jobs_lock:
+                waiters = job_waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del job_waiters[job_id]
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.get("/download/{job_id}")
-def download_result(job_id: str):
+def download_result(job_id: str, request: Request):
     job = jobs.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    if job.get("status") != "SUCCESS":
+    if job.status != "SUCCESS":
         raise HTTPException(status_code=400, detail="Job not completed")
-    path = job.get("result_path")
-    if not path or not os.path.exists(path):
+    path = job.result_path
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None:
         raise HTTPException(status_code=404, detail="Result not found")
-    filename = job.get("result_filename") or os.path.basename(path)
+    filename = job.result_filename or os.path.basename(path)
     # infer mime
     if path.endswith(".zip"):
         mime = "application/zip"
@@ -497,7 +767,24 @@ def download_result(job_id: str):
         mime = "application/vnd.apache.parquet"
     else:
         mime = "application/octet-stream"
-    return FileResponse(path, media_type=mime, filename=filename)
+    if X_ACCEL_REDIRECT_PREFIX:
+        # Behind nginx: hand the file to an internal location mapped onto outputs/
+        return Response(media_type=mime, headers={
+            "X-Accel-Redirect": X_ACCEL_REDIRECT_PREFIX + os.path.basename(path),
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+        })
+    headers = None
+    if mime == "text/csv":
+        headers = {"Vary": "Accept-Encoding"}
+        if _accepts_gzip(request):
+            try:
+                st, path = os.stat(path + ".gz"), path + ".gz"
+                headers["Content-Encoding"] = "gzip"
+            except OSError:
+                pass
+    # Passing the stat result skips Starlette's own os.stat round trip through a thread;
+    # servers offering the ASGI pathsend extension then send the file themselves
+    return ChunkedFileResponse(path, media_type=mime, filename=filename, stat_result=st, headers=headers)
 
 @app.get("/health", response_class=PlainTextResponse)
 async def health():
@@ -1,7 +1,10 @@
+import io
+import os
+import sys
 import pandas as pd
+import pyarrow as pa
 import xml.etree.ElementTree as ET
-from collections import defaultdict
-from typing import Iterator, Dict, Any, List
+from typing import Any, Dict, Generator, Iterator, List, Optional, Tuple, Union
 
 try:
     from lxml import etree as LET
@@ -9,188 +12,303 @@ try:
 except Exception:
     HAS_LXML = False
 
+# libxml2 keeps comments/PIs as tree nodes (ElementTree drops them); strip them
+# at parse time so every child we walk is a real element. Only internal entities
+# are expanded (no external/network fetches) and libxml2's size limits stay on.
+_LXML_OPTS = dict(remove_comments=True, remove_pis=True, remove_blank_text=True,
+                  resolve_entities="internal", no_network=True, huge_tree=False)
+
 # ----------- XML helpers (namespace-agnostic) -----------
 
-def localname(tag: str) -> str:
-    return tag.split('}', 1)[1] if '}' in tag else tag
-
-def element_to_dict(el: ET.Element):
-    """Element -> Python primitives (strip ns, attrs as @, lists for repeats)."""
-    data = {}
-    if el.attrib:
-        for k, v in el.attrib.items():
-            data[f"@{localname(k)}"] = v
-
-    kids = list(el)
-    if kids:
-        buckets = {}
-        for c in kids:
-            k = localname(c.tag)
-            v = element_to_dict(c)
-            if k in buckets:
-                if not isinstance(buckets[k], list):
-                    buckets[k] = [buckets[k]]
-                buckets[k].append(v)
-            else:
-                buckets[k] = v
-        data.update(buckets)
-        return data
-    else:
-        txt = (el.text or "").strip()
-        return txt if txt != "" else None
-
-def flatten_dict_all(obj, parent_key: str = "") -> dict:
-    """Flatten nested dicts/lists into dotted keys; lists indexed with [i]."""
-    flat = {}
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            nk = f"{parent_key}.{k}" if parent_key else k
-            if isinstance(v, dict):
-                flat.update(flatten_dict_all(v, nk))
-            elif isinstance(v, list):
-                for i, item in enumerate(v):
-                    flat.update(flatten_dict_all(item, f"{nk}[{i}]"))
+# Tag vocabulary is small and repeats on every row, so memoize the split (and
+# intern the result: every row's keys then share the same few string objects).
+_LOCAL_CACHE: Dict[str, str] = {}
+# Attribute name -> "@localname" key fragment
+_ATTR_KEY_CACHE: Dict[str, str] = {}
+
+def localname(tag: str, _c: Dict[str, str] = _LOCAL_CACHE) -> str:
+    v = _c.get(tag)
+    if v is None:
+        v = sys.intern(tag.rpartition('}')[2])
+        _c[tag] = v
+    return v
+
+def _attr_key(name: str, _c: Dict[str, str] = _ATTR_KEY_CACHE) -> str:
+    v = _c.get(name)
+    if v is None:
+        v = sys.intern("@" + localname(name))
+        _c[name] = v
+    return v
+
+_INDEX_SUFFIXES: List[str] = []
+
+def _index_suffix(i: int, _s: List[str] = _INDEX_SUFFIXES) -> str:
+    """"[i]", built once per index."""
+    while len(_s) <= i:
+        _s.append(f"[{len(_s)}]")
+    return _s[i]
+
+def element_to_flat(el: ET.Element, prefix: str = "", out: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Element -> flat dotted-key dict in one walk (namespaces stripped).
+
+    Attributes become "@name" keys and leaf text (stripped, "" -> None) sits
+    under the leaf's dotted path; repeated children are indexed with [i]. A leaf
+    element contributes only its text.
+    """
+    if out is None:
+        out = {}
+    if not len(el):
+        if prefix:
+            txt = (el.text or "").strip()
+            out[prefix] = txt if txt != "" else None
+        return out
+    dot = prefix + "." if prefix else ""
+    for k, v in el.attrib.items():
+        out[dot + _attr_key(k)] = v
+    groups: Dict[str, List[ET.Element]] = {}
+    for c in el:
+        k = localname(c.tag)
+        g = groups.get(k)
+        if g is None:
+            groups[k] = [c]
+        else:
+            g.append(c)
+    # Leaf children (most of them) are written here; only nested ones recurse
+    for k, kids in groups.items():
+        if len(kids) == 1:
+            c = kids[0]
+            if len(c):
+                element_to_flat(c, dot + k, out)
             else:
-                flat[nk] = v
-    elif isinstance(obj, list):
-        for i, item in enumerate(obj):
-            flat.update(flatten_dict_all(item, f"{parent_key}[{i}]" if parent_key else f"[{i}]"))
-    else:
-        if parent_key:
-            flat[parent_key] = obj
-    return flat
+                txt = (c.text or "").strip()
+                out[dot + k] = txt if txt != "" else None
+        else:
+            key = dot + k
+            for i, c in enumerate(kids):
+                if len(c):
+                    element_to_flat(c, key + _index_suffix(i), out)
+                else:
+                    txt = (c.text or "").strip()
+                    out[key + _index_suffix(i)] = txt if txt != "" else None
+    return out
 
 # ----------- Row detection (repeating pattern; no TxId reliance) -----------
 
-def detect_repeating_rows(root: ET.Element):
+def _iterparse_start_end(source: Any) -> Iterator[Tuple[str, Any]]:
+    if HAS_LXML:
+        return LET.iterparse(source, events=("start", "end"), **_LXML_OPTS)
+    return ET.iterparse(source, events=("start", "end"))
+
+def _release(elem: Any, parent: Any) -> None:
+    """Free a processed element and its already-processed earlier siblings.
+
+    iterparse reads ahead, so by an element's end event later siblings may
+    already be in the tree: it is NOT necessarily its parent's last child.
+    del parent[:-1] is still safe because the parent's last child is always
+    the node currently being parsed (kept), and read-ahead elements whose
+    events are still queued stay alive through those events' references
+    (works for lxml and ElementTree alike).
     """
-    Heuristic to find a repeating element (row type) WITHOUT TxId:
-      - For each parent, group its direct children by localname.
-      - Candidate groups have count >= 2 (repeated siblings).
-      - Choose the group with the highest count; tie-breaker = deepest parent.
-    Fallbacks: root's children else [root].
+    elem.clear()
+    if parent is not None:
+        del parent[:-1]
+
+def _xml_source(xml: Union[bytes, str]) -> Any:
+    """Raw bytes are wrapped for iterparse; a str is taken as a file path."""
+    return io.BytesIO(xml) if isinstance(xml, bytes) else xml
+
+def iter_row_elements(xml: Union[bytes, str]) -> Iterator[Any]:
+    """Stream the repeating row elements (no TxId reliance), without keeping a tree.
+
+    Pass 1 counts each parent's children by localname (parents are identified by
+    their start-order index) and keeps the largest group, deepest parent winning
+    ties. Pass 2 yields that parent's matching children, clearing each one once
+    the caller has consumed it. Same fallbacks: root's children, else the root.
+    Accepts the document as bytes or as a file path. Uses lxml when available,
+    else ElementTree's iterparse.
     """
-    best = {"count": 0, "depth": -1, "name": None, "elems": None}
-    stack = [(root, 0)]
-    while stack:
-        parent, depth = stack.pop()
-        children = list(parent)
-        if children:
-            groups = defaultdict(list)
-            for ch in children:
-                groups[localname(ch.tag)].append(ch)
-            for name, els in groups.items():
-                c = len(els)
-                if c >= 2:
-                    if (c > best["count"]) or (c == best["count"] and depth > best["depth"]):
-                        best = {"count": c, "depth": depth, "name": name, "elems": els}
-            for ch in children:
-                stack.append((ch, depth + 1))
-    if best["elems"] is not None:
-        return best["elems"]
-    rc = list(root)
-    return rc if rc else [root]
-
-def xml_rows_to_dataframe(xml_bytes: bytes) -> pd.DataFrame:
-    root = ET.fromstring(xml_bytes)
-    row_elems = detect_repeating_rows(root)
-    rows = []
+    # Pass 1: (count, depth, parent index, localname) of the winning group
+    best: Tuple[int, int, Optional[int], Optional[str]] = (0, -1, None, None)
+    root_has_children = False
+    seq = 0
+    stack: List[Tuple[int, Dict[str, int], Any]] = []
+    for event, elem in _iterparse_start_end(_xml_source(xml)):
+        if event == "start":
+            stack.append((seq, {}, elem))
+            seq += 1
+            continue
+        idx, counts, _ = stack.pop()
+        depth = len(stack)
+        name, c = None, 1
+        for n, cnt in counts.items():
+            if cnt > c:
+                name, c = n, cnt
+        # Later (deeper-first) parents win exact ties
+        if name is not None and (c > best[0] or (c == best[0] and depth >= best[1])):
+            best = (c, depth, idx, name)
+        if stack:
+            parent_counts = stack[-1][1]
+            local = localname(elem.tag)
+            parent_counts[local] = parent_counts.get(local, 0) + 1
+            _release(elem, stack[-1][2])
+        elif counts:
+            root_has_children = True
+
+    target_idx, target_name = best[2], best[3]
+    if target_idx is None:
+        target_idx = 0
+        if not root_has_children:
+            target_idx = None  # the root itself is the only row
+
+    # Pass 2: yield children of the winning parent (any name for the root fallback)
+    seq = 0
+    path: List[Tuple[int, Any]] = []
+    in_row = False
+    for event, elem in _iterparse_start_end(_xml_source(xml)):
+        if event == "start":
+            if path and path[-1][0] == target_idx and not in_row and (
+                    target_name is None or localname(elem.tag) == target_name):
+                in_row = True
+            path.append((seq, elem))
+            seq += 1
+            continue
+        path.pop()
+        if target_idx is None:
+            yield elem
+            return
+        parent = path[-1] if path else None
+        if in_row and parent is not None and parent[0] == target_idx:
+            in_row = False
+            yield elem
+            _release(elem, parent[1])
+        elif not in_row:
+            _release(elem, parent[1] if parent is not None else None)
+
+def xml_rows_to_dataframe(xml: Union[bytes, str]) -> pd.DataFrame:
+    row_elems = iter_row_elements(xml)
+    # Build column lists directly (sparse rows are None-padded) and let Arrow
+    # assemble the frame instead of pandas' list-of-dicts path.
+    columns: Dict[str, List[Any]] = {}
+    n = 0
     for el in row_elems:
-        obj = element_to_dict(el)
-        flat = flatten_dict_all(obj)
-        rows.append(flat)
-    df = pd.DataFrame(rows)
-    if not df.empty:
-        # Keep original order by default; caller can reindex if needed
-        pass
-    return df
+        for k, v in element_to_flat(el).items():
+            col = columns.get(k)
+            if col is None:
+                col = columns[k] = []
+            if len(col) < n:
+                col.extend([None] * (n - len(col)))
+            col.append(v)
+        n += 1
+    if not columns:
+        return pd.DataFrame(index=range(n))
+    for col in columns.values():
+        if len(col) < n:
+            col.extend([None] * (n - len(col)))
+    table = pa.table({k: pa.array(v, type=pa.string()) for k, v in columns.items()})
+    # The table is ours alone, so let Arrow release its buffers as it converts them
+    return table.to_pandas(types_mapper=pd.ArrowDtype, self_destruct=True)
 
 
 # ----------- Streaming row generator (lxml.iterparse) -----------
 
-def iter_xml_rows(xml_path: str) -> Iterator[Dict[str, Any]]:
+def _open_sequential(path: str) -> Any:
+    """Open path for a front-to-back read: 1 MiB buffer, sequential readahead hint."""
+    f = open(path, "rb", buffering=1 << 20)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
+def detect_row_tag(xml_path: str) -> Optional[str]:
+    """Localname of the row element iter_xml_rows streams, or None (needs lxml).
+
+    One light pass finds the most repeated child tag name under a single parent,
+    with the same tie rule as iter_row_elements (deepest parent wins, then the
+    later one); if nothing repeats, the root's first child name (noted on the
+    way) is used.
+    """
+    best_name = None
+    best_count = 1  # a group needs at least two siblings
+    best_depth = -1
+    first_child_local = None  # fallback when nothing repeats
+    with _open_sequential(xml_path) as f:
+        context = LET.iterparse(f, events=("start", "end"), **_LXML_OPTS)
+        # One {localname: count} per open element, counting its children so far
+        counts_stack: List[Dict[str, int]] = []
+        for event, elem in context:
+            if event == "start":
+                if first_child_local is None and len(counts_stack) == 1:
+                    first_child_local = localname(elem.tag)
+                counts_stack.append({})
+                continue
+            # The element's own children are all counted now: weigh its largest group
+            counts = counts_stack.pop()
+            depth = len(counts_stack)
+            name, c = None, 1
+            for n, cnt in counts.items():
+                if cnt > c:
+                    name, c = n, cnt
+            if name is not None and (c > best_count or (c == best_count and depth >= best_depth)):
+                best_name, best_count, best_depth = name, c, depth
+            if counts_stack:
+                parent_counts = counts_stack[-1]
+                local = localname(elem.tag)
+                parent_counts[local] = parent_counts.get(local, 0) + 1
+            # clear from memory, dropping the already-counted earlier siblings too
+            _release(elem, elem.getparent())
+        del context
+    return best_name if best_name is not None else first_child_local
+
+def iter_xml_rows(xml_path: str, row_tag: Optional[str] = None) -> Generator[Dict[str, Any], None, None]:
     """Yield flattened row dicts by streaming the XML file.
 
-    Heuristic: same as detect_repeating_rows, but in streaming form we need a
-    target tag. We first do a light pass to find the most repeated child tag
-    name, then do a second pass yielding each element of that tag.
-    Falls back to root children if no repetition found.
+    Heuristic: the largest group of same-named siblings (deepest parent wins
+    ties). In streaming form we need a target tag: detect_row_tag finds it
+    (pass row_tag to reuse an earlier detection), then a second pass yields
+    each element of that tag.
     """
     if not HAS_LXML:
-        # Fallback: load whole file (non-streaming)
-        with open(xml_path, "rb") as f:
-            data = f.read()
-        df = xml_rows_to_dataframe(data)
-        for _, row in df.iterrows():
-            yield {k: (None if pd.isna(v) else v) for k, v in row.to_dict().items()}
+        # Fallback: ElementTree's iterparse, flattening rows straight to dicts
+        for el in iter_row_elements(xml_path):
+            yield element_to_flat(el)
         return
 
-    # First pass: detect candidate row tag by counting sibling repetitions
-    best_name = None
-    best_count = 0
-    context = LET.iterparse(xml_path, events=("start", "end"))
-    stack_names: List[str] = []
-    sibling_counts_stack: List[defaultdict] = []
-    for event, elem in context:
-        if event == "start":
-            stack_names.append(elem.tag)
-            sibling_counts_stack.append(defaultdict(int))
-        else:  # end
-            # update parent sibling count
-            if len(sibling_counts_stack) >= 2:
-                parent_counts = sibling_counts_stack[-2]
-                local = elem.tag.split('}', 1)[1] if '}' in elem.tag else elem.tag
-                parent_counts[local] += 1
-                c = parent_counts[local]
-                if c >= 2 and c > best_count:
-                    best_count = c
-                    best_name = local
-            # pop stacks when element ends
-            stack_names.pop()
-            sibling_counts_stack.pop()
-            # clear from memory
-            elem.clear()
-    del context
-
-    # Second pass: stream over chosen tag
-    target_local = best_name
-    # If we didn't find a repeated tag, we try the first child name under root
+    target_local = row_tag or detect_row_tag(xml_path)
     if target_local is None:
-        context = LET.iterparse(xml_path, events=("start", "end"))
-        root_seen = False
-        first_child_local = None
+        # Give up: no repeating structure, the whole document is one row
+        for el in iter_row_elements(xml_path):
+            yield element_to_flat(el)
+        return
+
+    # Now iterate and yield per target element end. libxml2 filters on the
+    # namespace-agnostic tag itself, so only row elements reach Python.
+    with _open_sequential(xml_path) as f:
+        context = LET.iterparse(f, events=("start", "end"), tag="{*}" + target_local, **_LXML_OPTS)
+        open_rows = 0
         for event, elem in context:
-            if event == "start" and not root_seen:
-                # root start
-                root_seen = True
-            elif event == "start" and root_seen and first_child_local is None:
-                first_child_local = elem.tag.split('}', 1)[1] if '}' in elem.tag else elem.tag
-                break
+            if event == "start":
+                open_rows += 1
+                continue
+            open_rows -= 1
+            yield element_to_flat(elem)
+            if open_rows:
+                elem.clear()  # an enclosing row is still being built
+            else:
+                _release(elem, elem.getparent())
         del context
-        target_local = first_child_local
 
-    if target_local is None:
-        # Give up: no structure, parse whole
-        with open(xml_path, "rb") as f:
-            data = f.read()
-        df = xml_rows_to_dataframe(data)
-        for _, row in df.iterrows():
-            yield {k: (None if pd.isna(v) else v) for k, v in row.to_dict().items()}
-        return
+def preview_rows(xml_path: str, n: int = 10, row_tag: Optional[str] = None) -> Tuple[List[str], Dict[str, List[Any]], int]:
+    """First n rows of iter_xml_rows, column-major: (columns, {column: values}, row count).
 
-    # Now iterate and yield per target element end
-    ns_agnostic_suffix = "}" + target_local
-    context = LET.iterparse(xml_path, events=("end",))
-    for event, elem in context:
-        tag = elem.tag
-        is_match = False
-        if '}' in tag:
-            is_match = tag.endswith(ns_agnostic_suffix)
-        else:
-            is_match = (tag == target_local)
-        if is_match:
-            obj = element_to_dict(elem)
-            flat = flatten_dict_all(obj)
-            yield flat
-            elem.clear()
-    del context
\ No newline at end of file
+    Rows come from the same row detection the conversion uses. The columns are
+    the union over every row of the file (first-seen order), since the UI sends
+    them back as the export's columns; only the first n rows' values are kept,
+    with None for missing cells.
+    """
+    rows: List[Dict[str, Any]] = []
+    columns: Dict[str, None] = {}
+    for i, r in enumerate(iter_xml_rows(xml_path, row_tag)):
+        if i < n:
+            rows.append(r)
+        columns.update(dict.fromkeys(r))
+    cols = list(columns)
+    return cols, {c: [r.get(c) for r in rows] for c in cols}, len(rows)
@@ -0,0 +1,188 @@
+import gzip
+import os
+import shutil
+from itertools import chain
+from typing import Dict, Iterator, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import xlsxwriter
+
+from core import HAS_LXML, detect_row_tag, iter_xml_rows, preview_rows
+
+# Streaming XML -> CSV/Parquet/XLSX writers, shared by the web app's worker
+# processes and the Celery worker (kept free of FastAPI so workers import only this)
+
+# Writers go through a 1 MiB buffer, so a batch lands in a few large write() calls
+OUTPUT_BUFFER_BYTES = 1 << 20
+CSV_BATCH_ROWS = 65536
+# zstd level 1 compresses at Snappy-like speed with smaller files; each buffered
+# batch is written as one row group of up to PARQUET_ROW_GROUP rows
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+PARQUET_ROW_GROUP = int(os.getenv("PARQUET_ROW_GROUP", "131072"))
+
+def row_tag_path(xml_path: str) -> str:
+    """Sidecar where /preview records the row tag it detected for an upload."""
+    return os.path.splitext(xml_path)[0] + ".rowtag"
+
+def iter_upload_rows(xml_path: str):
+    """iter_xml_rows for an upload, reusing /preview's row detection when recorded
+    so the export doesn't repeat that full pass over the file."""
+    try:
+        with open(row_tag_path(xml_path), encoding="utf-8") as f:
+            row_tag = f.read() or None
+    except OSError:
+        row_tag = None
+    return iter_xml_rows(xml_path, row_tag)
+
+def _nonempty_rows(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Drop rows whose cells are all null or empty strings."""
+    keep = None
+    for arr in batch.columns:
+        has_value = pc.fill_null(pc.not_equal(arr, ""), False)
+        keep = has_value if keep is None else pc.or_(keep, has_value)
+    return batch.filter(keep)
+
+def _column_batches(rows: Iterator[Dict], header: List[str], batch_size: int) -> Iterator[List[List]]:
+    """Regroup row dicts into per-column value lists (header order), batch_size rows at a time.
+
+    The same lists are cleared and refilled for every batch, so each one must be
+    consumed before the next is requested.
+    """
+    cols: List[List] = [[] for _ in header]
+    fill = list(zip([c.append for c in cols], header))
+    n = 0
+    for r in rows:
+        get = r.get
+        for append, k in fill:
+            append(get(k))
+        n += 1
+        if n == batch_size:
+            yield cols
+            for c in cols:
+                c.clear()
+            n = 0
+    if n:
+        yield cols
+
+def _string_batch(cols: List[List], schema: pa.Schema) -> pa.RecordBatch:
+    return pa.RecordBatch.from_arrays([pa.array(c, type=pa.string()) for c in cols], schema=schema)
+
+def stream_csv_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
+    # Rows are gathered column-wise and encoded a batch at a time by Arrow's C++
+    # CSV writer instead of one csv.DictWriter call per row.
+    rows = iter_upload_rows(xml_path)
+    if header_cols is not None:
+        header = list(header_cols)
+    else:
+        # Peek the first row for the header, then put it back: one parse, not two
+        first_row = next(rows, None)
+        header = list(first_row.keys()) if first_row else []
+        if first_row is not None:
+            rows = chain([first_row], rows)
+    if not header:
+        open(out_path, "wb").close()
+        return
+    schema = pa.schema([(k, pa.string()) for k in header])
+    with pa.output_stream(out_path, buffer_size=OUTPUT_BUFFER_BYTES) as sink, pacsv.CSVWriter(sink, schema) as writer:
+        for cols in _column_batches(rows, header, CSV_BATCH_ROWS):
+            writer.write_batch(_nonempty_rows(_string_batch(cols, schema)))
+
+def stream_parquet_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
+    # Rows are gathered column-wise and written as string batches under one fixed
+    # schema, instead of Table.from_pylist walking row dicts and re-inferring types.
+    rows = iter_upload_rows(xml_path)
+    if header_cols:
+        header = list(header_cols)
+    else:
+        first_row = next(rows, None)
+        header = list(first_row.keys()) if first_row else []
+        if first_row is not None:
+            rows = chain([first_row], rows)
+    schema = pa.schema([(k, pa.string()) for k in header])
+    level = 1 if PARQUET_COMPRESSION.lower() == "zstd" else None
+    with pa.output_stream(out_path, buffer_size=OUTPUT_BUFFER_BYTES) as sink, \
+            pq.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION, compression_level=level,
+                             use_dictionary=True, data_page_size=1 << 20) as writer:
+        if not header:
+            return
+        for cols in _column_batches(rows, header, PARQUET_ROW_GROUP):
+            writer.write_batch(_string_batch(cols, schema), row_group_size=PARQUET_ROW_GROUP)
+
+def _xlsx_write_row(write_string, row_idx: int, row_vals: List) -> None:
+    # Cells are str or None: call write_string directly and leave None cells
+    # unwritten, skipping write_row's per-value type dispatch and blank handling
+    for col, v in enumerate(row_vals):
+        if v is not None:
+            write_string(row_idx, col, v)
+
+def stream_xlsx_to_path(xml_path: str, out_path: str, header_cols: List[str] | None):
+    # constant_memory flushes each row to disk as it is written; use_zip64 lets
+    # large sheets exceed 4GB uncompressed. Values are data, so skip
+    # xlsxwriter's URL/formula/number sniffing on strings.
+    wb = xlsxwriter.Workbook(out_path, {
+        "constant_memory": True,
+        "use_zip64": True,
+        "strings_to_urls": False,
+        "strings_to_formulas": False,
+        "strings_to_numbers": False,
+    })
+    ws = wb.add_worksheet("Rows")
+    header = header_cols if header_cols else None
+    rows = iter_upload_rows(xml_path)
+    first_row = next(rows, None)
+    if header is None:
+        header = list(first_row.keys()) if first_row else []
+    if not header:
+        wb.close()
+        return
+    write_string = ws.write_string
+    _xlsx_write_row(write_string, 0, header)
+    row_idx = 1
+    if first_row is not None:
+        rows = chain([first_row], rows)
+    for r in rows:
+        # Cells are str or None, so truthiness is the "not None and not empty" test
+        row_vals = list(map(r.get, header))
+        if any(row_vals):
+            _xlsx_write_row(write_string, row_idx, row_vals)
+            row_idx += 1
+    wb.close()
+
+# ----------- Pool tasks (run in the web app's worker processes; imported by
+# reference, so workers load this module and core, never the FastAPI app) -----------
+
+def worker_init():
+    # Pay the heavy imports once per worker rather than on the first file it gets
+    import core, pyarrow.parquet, xlsxwriter  # noqa: F401
+
+def convert_one(xml_path: str, out_path: str, output_format: str, header_cols: List[str] | None):
+    try:
+        if output_format == "csv":
+            stream_csv_to_path(xml_path, out_path, header_cols)
+        elif output_format == "parquet":
+            stream_parquet_to_path(xml_path, out_path, header_cols)
+        else:
+            stream_xlsx_to_path(xml_path, out_path, header_cols)
+    except Exception as e:
+        # Runs in a worker process: lxml's XMLSyntaxError can't be pickled back to
+        # the job thread, so send only its message
+        raise RuntimeError(str(e)) from None
+
+def gzip_sibling(path: str):
+    """Write path + ".gz" at level 1 so /download can send CSV precompressed."""
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb", compresslevel=1) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+def preview_one(xml_path: str, n: int = 10):
+    try:
+        # Detect the row tag once here and keep it with the upload for /convert
+        row_tag = detect_row_tag(xml_path) if HAS_LXML else None
+        if row_tag:
+            with open(row_tag_path(xml_path), "w", encoding="utf-8") as f:
+                f.write(row_tag)
+        return preview_rows(xml_path, n, row_tag)
+    except Exception as e:
+        raise RuntimeError(str(e)) from None  # see convert_one